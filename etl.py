@@ -1,25 +1,50 @@
 # Import the necessary packages
 import configparser
-from datetime import datetime
-import os
+import pyspark
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col, to_timestamp, monotonically_increasing_id, row_number
+from pyspark.sql.functions import col, broadcast, monotonically_increasing_id, struct, max as spark_max, round as spark_round
 from pyspark.sql.functions import year, month, dayofweek, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.types import TimestampType
-from pyspark.sql.window import Window
-
-# Log in to AWS 
-config = configparser.ConfigParser()
-config.read('dl.cfg')
-
-os.environ['AWS_ACCESS_KEY_ID']=config['AWS_ACCESS_KEY_ID']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS_SECRET_ACCESS_KEY']
-
-
-def create_spark_session():
+from pyspark.sql.types import StructType, StructField, StringType, DoubleType, IntegerType, LongType, TimestampType
+
+# Explicit schemas for the input JSON files, so Spark does not need an extra pass to infer them
+SONG_SCHEMA = StructType([
+    StructField("song_id", StringType()),
+    StructField("title", StringType()),
+    StructField("artist_id", StringType()),
+    StructField("year", IntegerType()),
+    StructField("duration", DoubleType()),
+    StructField("artist_name", StringType()),
+    StructField("artist_location", StringType()),
+    StructField("artist_latitude", DoubleType()),
+    StructField("artist_longitude", DoubleType())
+])
+
+LOG_SCHEMA = StructType([
+    StructField("userId", StringType()),
+    StructField("firstName", StringType()),
+    StructField("lastName", StringType()),
+    StructField("gender", StringType()),
+    StructField("level", StringType()),
+    StructField("page", StringType()),
+    StructField("ts", LongType()),
+    StructField("song", StringType()),
+    StructField("artist", StringType()),
+    StructField("length", DoubleType()),
+    StructField("sessionId", LongType()),
+    StructField("location", StringType()),
+    StructField("userAgent", StringType())
+])
+
+
+def create_spark_session(aws_access_key_id, aws_secret_access_key):
     """
     Creates a new SparkSession or gets an existing one if available.
     
+    Arguments:
+    - aws_access_key_id (str): The AWS access key ID used by the S3A filesystem.
+    - aws_secret_access_key (str): The AWS secret access key used by the S3A filesystem.
+    
     Returns:
     - spark (SparkSession): A SparkSession object.
     
@@ -27,11 +52,34 @@ def create_spark_session():
     - None
     
     Restrictions:
-    - None
+    - The spark-hadoop-cloud package is resolved for the installed PySpark version and its Scala version
+      (2.13 from Spark 4 on, 2.12 before); it brings in the hadoop-aws version that this Spark release is built against.
     """
+    scala_version = "2.13" if int(pyspark.__version__.split(".")[0]) >= 4 else "2.12"
     spark = SparkSession \
         .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.jars.packages", "org.apache.spark:spark-hadoop-cloud_" + scala_version + ":" + pyspark.__version__) \
+        .config("spark.hadoop.fs.s3a.access.key", aws_access_key_id) \
+        .config("spark.hadoop.fs.s3a.secret.key", aws_secret_access_key) \
+        .config("spark.sql.shuffle.partitions", "400") \
+        .config("spark.sql.files.maxPartitionBytes", "256MB") \
+        .config("spark.sql.adaptive.enabled", "true") \
+        .config("spark.sql.adaptive.coalescePartitions.enabled", "true") \
+        .config("spark.sql.adaptive.advisoryPartitionSizeInBytes", "128m") \
+        .config("spark.sql.adaptive.coalescePartitions.minPartitionSize", "4m") \
+        .config("spark.sql.adaptive.skewJoin.enabled", "true") \
+        .config("spark.sql.autoBroadcastJoinThreshold", "50MB") \
+        .config("spark.reducer.maxSizeInFlight", "96m") \
+        .config("spark.shuffle.file.buffer", "1m") \
+        .config("spark.shuffle.compress", "true") \
+        .config("spark.shuffle.spill.compress", "true") \
+        .config("spark.io.compression.codec", "lz4") \
+        .config("spark.sql.parquet.compression.codec", "snappy") \
+        .config("spark.memory.fraction", "0.7") \
+        .config("spark.hadoop.fs.s3a.committer.name", "magic") \
+        .config("spark.hadoop.fs.s3a.committer.magic.enabled", "true") \
+        .config("spark.sql.sources.commitProtocolClass", "org.apache.spark.internal.io.cloud.PathOutputCommitProtocol") \
+        .config("spark.sql.parquet.output.committer.class", "org.apache.spark.internal.io.cloud.BindingParquetOutputCommitter") \
         .getOrCreate()
     return spark
 
@@ -46,7 +94,7 @@ def process_song_data(spark, input_data, output_data):
     - output_data (str): The file path for the output data (Parquet files).
     
     Returns:
-    - None
+    - song_df (DataFrame): The persisted song columns needed for the songplays table, to be reused by process_log_data.
     
     Exceptions:
     - None
@@ -55,29 +103,42 @@ def process_song_data(spark, input_data, output_data):
     - The input_data parameter should include a trailing '/'.
     - The song_data files should be located in subdirectories under the input_data directory.
     - The output_data parameter should include a trailing '/'.
-    - The songs table will be partitioned by year and artist.
+    - The songs table will be partitioned by year.
     """
-    # get filepath to song data file
-    song_data = input_data + "song_data/*/*/*/*.json"
+    # get filepath to song data directory, all JSON files below it are read
+    song_data = input_data + "song_data/"
     
     # read song data file
-    df = spark.read.json(song_data)
+    df = spark.read.schema(SONG_SCHEMA) \
+                .option("recursiveFileLookup", "true") \
+                .option("pathGlobFilter", "*.json") \
+                .json(song_data)
+    # persist the song data, as it is used for the songs, artists and songplays tables
+    df = df.persist(StorageLevel.MEMORY_AND_DISK)
 
     # extract columns to create songs table
     songs_table = df.select(["song_id", "title", "artist_id", "year", "duration"])
-    songs_table = songs_table.dropDuplicates()
+    songs_table = songs_table.dropDuplicates(["song_id"])
     
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year", "artist_id").parquet(output_data + "songs", mode="overwrite")
+    # write songs table to parquet files partitioned by year, with one file per year directory
+    songs_table.repartition("year").write.partitionBy("year").parquet(output_data + "songs", mode="overwrite")
 
     # extract columns to create artists table
     artists_table = df.selectExpr(["artist_id", "artist_name as name", "artist_location as location", "artist_latitude as latitude", "artist_longitude as longitude"])
-    artists_table = artists_table.dropDuplicates()
+    artists_table = artists_table.dropDuplicates(["artist_id"])
     
-    # write artists table to parquet files
-    artists_table.write.parquet(output_data + "artists", mode="overwrite")
+    # write artists table to parquet files, coalesced into a few files
+    artists_table.coalesce(8).write.parquet(output_data + "artists", mode="overwrite")
+
+    # keep only the columns needed for the songplays join cached, and release the full song data
+    song_df = df.select("song_id", "title", "artist_id", "artist_name", "duration") \
+                .persist(StorageLevel.MEMORY_AND_DISK)
+    song_df.count()
+    df.unpersist()
+
+    return song_df
    
-def process_log_data(spark, input_data, output_data):
+def process_log_data(spark, input_data, output_data, song_df):
     """
     Processes log data from JSON files and creates three new tables: users, time, and songplays.
     
@@ -85,6 +146,7 @@ def process_log_data(spark, input_data, output_data):
     - spark (SparkSession): The SparkSession to use.
     - input_data (str): The file path for the input data (JSON files).
     - output_data (str): The file path for the output data (Parquet files).
+    - song_df (DataFrame): The song data returned by process_song_data.
     
     Returns:
     - None
@@ -103,68 +165,80 @@ def process_log_data(spark, input_data, output_data):
     # get filepath to log data file
     log_data = input_data + "log_data/*.json"
 
-    # read log data file
-    log_df = spark.read.json(log_data)
-    
-    # filter by actions for song plays
-    log_df = log_df.where(log_df.page == 'NextSong')
+    # read log data file, filter by actions for song plays and keep only the needed columns
+    log_df = spark.read.schema(LOG_SCHEMA).json(log_data) \
+                .filter(col("page") == 'NextSong') \
+                .select("userId", "firstName", "lastName", "gender", "level", "ts", "song", "artist", "length", "sessionId", "location", "userAgent")
 
-    # extract columns for users table    
-    user_table = log_df.selectExpr(["userId as user_id", "firstName as first_name", "lastName as last_name", "gender", "level"])
-    user_table = user_table.dropDuplicates()
-    
-    # write users table to parquet files
-    user_table.write.parquet(output_data + "parquet_log/user", mode="overwrite")
+    # create timestamp column from original timestamp column (ts is in milliseconds)
+    log_df = log_df.withColumn('start_time', (col('ts') / 1000).cast(TimestampType()))
+
+    # persist the log data, as it is used for the users, time and songplays tables
+    log_df = log_df.persist(StorageLevel.MEMORY_AND_DISK)
 
-    # create timestamp column from original timestamp column
-    # define the UDF to convert the timestamp column
-    get_timestamp = udf(lambda ts: datetime.fromtimestamp(ts / 1000), TimestampType())
+    # extract columns for users table, keeping the most recent event per user so the current level is used
+    user_table = log_df.groupBy(col("userId").alias("user_id")) \
+                        .agg(spark_max(struct("ts", "firstName", "lastName", "gender", "level")).alias("latest")) \
+                        .selectExpr(["user_id", "latest.firstName as first_name", "latest.lastName as last_name", "latest.gender as gender", "latest.level as level"])
+    
+    # write users table to parquet files, coalesced into a few files
+    user_table.coalesce(8).write.parquet(output_data + "parquet_log/user", mode="overwrite")
 
-    # create a new column with the converted timestamp
-    log_df = log_df.withColumn('start_time', to_timestamp(log_df.ts))
-      
     # extract columns to create time table
-    time_table = log_df.select('start_time')
-    time_table = time_table.withColumn('hour', hour('start_time'))
-    time_table = time_table.withColumn('day', dayofmonth('start_time'))
-    time_table = time_table.withColumn('week', weekofyear('start_time'))
-    time_table = time_table.withColumn('month', month('start_time'))
-    time_table = time_table.withColumn('year', year('start_time'))
-    time_table = time_table.withColumn('weekday', dayofweek('start_time'))
+    time_table = log_df.select(col('start_time'),
+                               hour('start_time').alias('hour'),
+                               dayofmonth('start_time').alias('day'),
+                               weekofyear('start_time').alias('week'),
+                               month('start_time').alias('month'),
+                               year('start_time').alias('year'),
+                               dayofweek('start_time').alias('weekday'))
 
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year", "month").parquet(output_data + "parquet_log/time_table", mode="overwrite")
-
-    # read in song data to use for songplays table
-    song_df = spark.read.json(input_data + "song_data/*/*/*/*.json")
+    time_table.repartition("year", "month").write.partitionBy("year", "month").parquet(output_data + "parquet_log/time_table", mode="overwrite")
 
     # extract columns from joined song and log datasets to create songplays table 
-    # join song_df and log_df
-    song_log_joined_table = log_df.join(song_df, (log_df.song == song_df.title) & (log_df.artist == song_df.artist_name) & (log_df.length == song_df.duration), how='inner')
+    # keep only the song columns needed for the songplays table, with one row per join key
+    # durations are compared as whole milliseconds, as equality on floating point values is fragile
+    song_small = song_df.select("song_id", "title", "artist_id", "artist_name",
+                                spark_round(col("duration") * 1000).cast(LongType()).alias("duration_ms")) \
+                        .dropDuplicates(["title", "artist_name", "duration_ms"])
+    log_play_df = log_df.withColumn("length_ms", spark_round(col("length") * 1000).cast(LongType()))
+    # join song_df and log_df, broadcasting the smaller song data to avoid shuffling log_df
+    song_log_joined_table = log_play_df.join(broadcast(song_small), (log_play_df.song == song_small.title) & (log_play_df.artist == song_small.artist_name) & (log_play_df.length_ms == song_small.duration_ms), how='inner')
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = song_log_joined_table.distinct() \
-                        .select("userId", "start_time", "song_id", "artist_id", "level", "sessionId", "location", "userAgent") \
-                        .withColumn("songplay_id", row_number().over( Window.partitionBy('start_time').orderBy("start_time"))) \
-                        .withColumnRenamed("userId","user_id")        \
-                        .withColumnRenamed("start_time","start_time")  \
-                        .withColumnRenamed("sessionId","session_id")  \
-                        .withColumnRenamed("userAgent", "user_agent") \
-                        .withColumn('year', year('start_time')) \
-                        .withColumn('month', month('start_time'))
+    songplays_table = song_log_joined_table.select(monotonically_increasing_id().alias("songplay_id"),
+                                                   col("userId").alias("user_id"),
+                                                   col("start_time"),
+                                                   col("song_id"),
+                                                   col("artist_id"),
+                                                   col("level"),
+                                                   col("sessionId").alias("session_id"),
+                                                   col("location"),
+                                                   col("userAgent").alias("user_agent"),
+                                                   year("start_time").alias("year"),
+                                                   month("start_time").alias("month"))
 
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy("year", "month").parquet(output_data + "parquet_log/songplays", mode="overwrite")
+    songplays_table.repartition("year", "month").write.partitionBy("year", "month").parquet(output_data + "parquet_log/songplays", mode="overwrite")
+
+    # release the cached log data
+    log_df.unpersist()
 
 
 # This function executes the programm    
 def main():
-    spark = create_spark_session()
-    input_data = 's3://udacity-dend/'
-    output_data = 'https://sparkproject23.s3.us-west-2.amazonaws.com/Output_Data/'
+    # Log in to AWS
+    config = configparser.ConfigParser()
+    config.read('dl.cfg')
+
+    spark = create_spark_session(config['AWS']['AWS_ACCESS_KEY_ID'], config['AWS']['AWS_SECRET_ACCESS_KEY'])
+    input_data = 's3a://udacity-dend/'
+    output_data = 's3a://sparkproject23/Output_Data/'
     
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    song_df = process_song_data(spark, input_data, output_data)    
+    process_log_data(spark, input_data, output_data, song_df)
+    song_df.unpersist()
 
 
 if __name__ == "__main__":